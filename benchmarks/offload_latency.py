@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from asyncio import gather
+from asyncio import get_event_loop
+from time import perf_counter
+
+from aiohttp_xmlrpc.client import ServerProxy
+
+from aioros_master import Master
+
+
+async def large_param_traffic(uri, loop, size, stop, index):
+    client = ServerProxy(uri, loop=loop)
+    urdf = '<robot name="bench">' + 'x' * size + '</robot>'
+    key = 0
+    try:
+        while not stop:
+            await client.setParam('/bench', '/robot_description', urdf)
+            # new keys change the param tree while it is being encoded
+            key += 1
+            await client.setParam('/bench', f'/bench/{index}/key_{key}', key)
+            await client.getParam('/bench', '/')
+    finally:
+        await client.close()
+
+
+async def measure(loop, args, offload_threshold):
+    master = Master()
+    await master.init(
+        loop,
+        host='127.0.0.1',
+        port=0,
+        offload_threshold=offload_threshold,
+        offload_processes=args.processes)
+    client = ServerProxy(master.uri, loop=loop)
+    await client.registerPublisher(
+        '/bench', '/chatter', 'std_msgs/String', 'http://127.0.0.1:1/')
+
+    stop = []
+    traffic = gather(*[
+        large_param_traffic(master.uri, loop, args.size, stop, index)
+        for index in range(args.concurrency)])
+
+    latencies = []
+    for _ in range(args.lookups):
+        start = perf_counter()
+        await client.lookupNode('/bench', '/bench')
+        latencies.append(perf_counter() - start)
+
+    stop.append(True)
+    await traffic
+    await client.close()
+    await master.close()
+
+    latencies.sort()
+    return (latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)])
+
+
+def main():
+    parser = ArgumentParser(
+        description='Measure lookupNode latency during large param traffic')
+    parser.add_argument('--size', type=int, default=4 << 20,
+                        help='size of the large param in bytes')
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--threshold', type=int, default=1 << 20)
+    parser.add_argument('--processes', type=int, default=0)
+    args = parser.parse_args()
+
+    loop = get_event_loop()
+    for name, threshold in (('on loop', None), ('offloaded', args.threshold)):
+        p50, p99 = loop.run_until_complete(measure(loop, args, threshold))
+        print(f'{name:10s} lookupNode p50 {p50 * 1000:8.2f} ms '
+              f'p99 {p99 * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
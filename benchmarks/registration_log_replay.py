@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from asyncio import new_event_loop
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from aioros_master.registration_log import RegistrationLog
+from aioros_master.registration_manager import RegistrationManager
+
+
+def write_log(loop, log_path, nodes, topics, churn):
+    log = RegistrationLog(log_path, compact_threshold=float('inf'))
+    manager = RegistrationManager(loop, False, log)
+    for n in range(nodes):
+        caller_id = f'/node_{n}'
+        caller_api = f'http://host:{40000 + n}/'
+        for t in range(topics):
+            topic = f'/topic_{(n + t) % (nodes * topics // 4 + 1)}'
+            manager.register_publisher(
+                topic, 'std_msgs/String', caller_id, caller_api)
+            manager.register_subscriber(
+                topic + '_in', 'std_msgs/String', caller_id, caller_api)
+        manager.register_service(
+            caller_id + '/get_loggers',
+            caller_id,
+            caller_api,
+            f'rosrpc://host:{50000 + n}')
+        manager.register_param_subscriber(
+            caller_id + '/config', caller_id, caller_api)
+        for c in range(churn):
+            manager.unregister_subscriber(
+                f'/topic_{c}_in', caller_id, caller_api)
+            manager.register_subscriber(
+                f'/topic_{c}_in', 'std_msgs/String', caller_id, caller_api)
+    log.close()
+    with open(log_path) as f:
+        return sum(1 for _ in f)
+
+
+def main():
+    parser = ArgumentParser(
+        description='Measure the replay time of the registration log')
+    parser.add_argument('--nodes', type=int, nargs='+',
+                        default=[100, 1000, 5000])
+    parser.add_argument('--topics', type=int, default=10)
+    parser.add_argument('--churn', type=int, default=2)
+    args = parser.parse_args()
+
+    loop = new_event_loop()
+    with TemporaryDirectory() as tmp:
+        for nodes in args.nodes:
+            log_path = path.join(tmp, f'registrations_{nodes}.log')
+            entries = write_log(loop, log_path, nodes, args.topics, args.churn)
+            manager = RegistrationManager(
+                loop, registration_log=RegistrationLog(log_path))
+            start = perf_counter()
+            manager.replay_log()
+            elapsed = perf_counter() - start
+            with open(log_path) as f:
+                compacted = sum(1 for _ in f)
+            print(f'{nodes:6d} nodes {entries:8d} entries: '
+                  f'replay + compaction {elapsed * 1000:8.1f} ms, '
+                  f'{compacted} entries after compaction')
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
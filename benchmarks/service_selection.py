@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from asyncio import new_event_loop
+from collections import Counter
+
+from aioros_master.registration_manager import RegistrationManager
+from aioros_master.service_selection import SERVICE_SELECTIONS
+
+
+def main():
+    parser = ArgumentParser(
+        description='Show how lookupService spreads over service providers')
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--rtts', type=float, nargs='+',
+                        default=[0.001, 0.002, 0.005, 0.02],
+                        help='simulated callback round trip times of the '
+                             'providers in seconds')
+    args = parser.parse_args()
+
+    loop = new_event_loop()
+    for name, selection in sorted(SERVICE_SELECTIONS.items()):
+        manager = RegistrationManager(
+            loop, notify_nodes=False, service_selection=selection())
+        for i, rtt in enumerate(args.rtts):
+            caller_id = f'/provider_{i}'
+            manager.register_service(
+                '/add_two_ints',
+                caller_id,
+                f'http://host:{40000 + i}/',
+                f'rosrpc://host:{50000 + i}')
+            manager._nodes[caller_id].rtt = rtt
+
+        distribution = Counter(
+            manager.get_service_api('/add_two_ints')
+            for _ in range(args.lookups))
+        print(name)
+        for i, rtt in enumerate(args.rtts):
+            share = distribution[f'rosrpc://host:{50000 + i}'] / args.lookups
+            print(f'  provider_{i} rtt {rtt * 1000:6.1f} ms: {share:6.1%}')
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+from asyncio import Task
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 
 from aiohttp.web import AppRunner
@@ -7,7 +9,10 @@ from aioros.graph_resource import get_local_address
 
 from .master_api_server import start_server
 from .param_cache import ParamCache
+from .registration_log import RegistrationLog
 from .registration_manager import RegistrationManager
+from .service_selection import SERVICE_SELECTIONS
+from .upstream import UpstreamMaster
 
 
 class Master:
@@ -16,27 +21,74 @@ class Master:
         self._param_cache: Optional[ParamCache] = None
         self._registration_manager: Optional[RegistrationManager] = None
         self._server: Optional[AppRunner] = None
+        self._upstream: Optional[UpstreamMaster] = None
         self._uri: Optional[str] = None
+        self._liveness_check: Optional[Task] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def uri(self) -> Optional[str]:
+        return self._uri
 
     async def init(
         self,
         loop,
         host: str = None,
         port: int = 11311,
+        upstream_uri: str = None,
+        registration_log: str = None,
+        service_selection: str = 'round_robin',
+        offload_threshold: Optional[int] = 1 << 20,
+        offload_processes: int = 0,
+        max_request_size: int = 64 << 20,
     ) -> None:
         host = host or get_local_address()
-        self._registration_manager = RegistrationManager(loop)
+        if upstream_uri:
+            self._upstream = UpstreamMaster(loop, upstream_uri)
+        # in proxy mode the upstream master notifies the nodes itself
+        self._registration_manager = RegistrationManager(
+            loop,
+            notify_nodes=self._upstream is None,
+            registration_log=(RegistrationLog(registration_log)
+                              if registration_log else None),
+            service_selection=SERVICE_SELECTIONS[service_selection]())
+        if registration_log:
+            self._registration_manager.replay_log()
         self._param_cache = ParamCache()
+        if offload_processes:
+            self._executor = ProcessPoolExecutor(offload_processes)
         self._server, self._uri = await start_server(
             host,
             port,
             self._param_cache,
-            self._registration_manager)
+            self._registration_manager,
+            self._upstream,
+            offload_threshold,
+            self._executor,
+            max_request_size)
+        if self._upstream:
+            try:
+                await self._upstream.init(self._param_cache, self._uri)
+            except Exception:
+                await self.close()
+                raise
+        if registration_log:
+            self._liveness_check = loop.create_task(
+                self._registration_manager.check_liveness())
 
     async def close(self) -> None:
+        if self._liveness_check:
+            self._liveness_check.cancel()
+            self._liveness_check = None
+        if self._upstream:
+            await self._upstream.close()
+            self._upstream = None
         if self._server:
             await self._server.cleanup()
             self._server = None
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
         self._param_cache = None
         if self._registration_manager:
             await self._registration_manager.close()
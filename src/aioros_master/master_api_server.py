@@ -1,22 +1,40 @@
 from asyncio import get_event_loop
+from concurrent.futures import Executor
+from copy import deepcopy
 from inspect import getfullargspec
+from logging import getLogger
 from os import getpid
 from os import kill
 from signal import SIGINT
 from types import MappingProxyType
 from typing import Any
+from typing import Callable
 from typing import List
+from typing import Optional
 from typing import Tuple
 
 from aiohttp.web import AppRunner
 from aiohttp.web import Application
+from aiohttp.web import HTTPBadRequest
+from aiohttp.web import HTTPError
+from aiohttp.web import Response
 from aiohttp.web import TCPSite
+from aiohttp_xmlrpc.common import py2xml
+from aiohttp_xmlrpc.common import schema
+from aiohttp_xmlrpc.common import xml2py
 from aiohttp_xmlrpc.handler import XMLRPCView
+from lxml import etree
 
 from .param_cache import ParamCache
 from .registration_manager import RegistrationManager
+from .registration_manager import SystemStateChanges
+from .upstream import UpstreamError
+from .upstream import UpstreamFault
+from .upstream import UpstreamMaster
 
 
+log = getLogger(__name__)
+
 AnyResult = Tuple[int, str, Any]
 BoolResult = Tuple[int, str, bool]
 IntResult = Tuple[int, str, int]
@@ -24,6 +42,51 @@ StrResult = Tuple[int, str, str]
 TopicInfo = Tuple[str, str]
 
 
+class InvalidRequest(Exception):
+    pass
+
+
+def decode_request(body: bytes) -> Tuple[str, List[Any]]:
+    parser = etree.XMLParser(resolve_entities=False, huge_tree=True)
+    root = etree.fromstring(body, parser)
+    try:
+        schema.assertValid(root)
+    except etree.DocumentInvalid as e:
+        # lxml exceptions cannot be sent back from a worker process
+        raise InvalidRequest(str(e))
+    return root.findtext('methodName'), [
+        xml2py(value) for value in root.iterfind('params/param/value')]
+
+
+def encode_response(result: Any) -> bytes:
+    response = etree.Element('methodResponse')
+    value = etree.SubElement(
+        etree.SubElement(etree.SubElement(response, 'params'), 'param'),
+        'value')
+    value.append(py2xml(result))
+    return etree.tostring(response, xml_declaration=True, encoding='utf-8')
+
+
+def reaches_size(value: Any, size: int) -> bool:
+    # Rough estimate of the encoded size which stops as soon as the given
+    # size is reached, so it is cheap for both small and large values.
+    worklist = [value]
+    while worklist:
+        value = worklist.pop()
+        if isinstance(value, (str, bytes)):
+            size -= len(value)
+        elif isinstance(value, dict):
+            worklist.extend(value.keys())
+            worklist.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            worklist.extend(value)
+        # markup around each value
+        size -= 32
+        if size <= 0:
+            return True
+    return False
+
+
 class MasterApi(XMLRPCView):
 
     def __init__(self, request):
@@ -37,6 +100,64 @@ class MasterApi(XMLRPCView):
         allowed_methods['system.multicall'] = 'rpc_multicall'
         self.__allowed_methods__ = MappingProxyType(allowed_methods)
 
+    async def post(self, *args, **kwargs) -> Response:
+        # Same contract as XMLRPCView.post, but the request is decoded and
+        # the response encoded in the executor if either of them reaches
+        # the offload threshold. Overriding only the parse and format hooks
+        # would still convert the values and serialize on the event loop.
+        try:
+            xml_response = await self._handle_offloaded()
+        except HTTPError:
+            raise
+        except Exception as e:
+            log.exception(e)
+            return self._make_response(self._format_error(e))
+
+        return Response(
+            body=xml_response,
+            headers={'Content-Type': 'text/xml; charset=utf-8'})
+
+    async def _handle_offloaded(self) -> bytes:
+        self._check_request()
+        threshold = self.request.app['offload_threshold']
+        body = await self.request.read()
+        try:
+            method_name, params = await self._offload(
+                threshold is not None and len(body) >= threshold,
+                decode_request,
+                body)
+        except InvalidRequest:
+            raise HTTPBadRequest()
+        method = self._lookup_method(method_name)
+        log.info(
+            'RPC Call: %s => %s.%s.%s',
+            method_name,
+            method.__module__,
+            type(self).__name__,
+            method.__name__)
+        result = await method(*params)
+        return await self._encode(result)
+
+    async def _encode(self, result: Any) -> bytes:
+        threshold = self.request.app['offload_threshold']
+        if threshold is None or not reaches_size(result, threshold):
+            return encode_response(result)
+        # Results like getParam('/') refer to the live param cache, which
+        # may change on the event loop while being encoded or pickled by
+        # the executor. Strings are immutable, so the copy is cheap.
+        return await self._offload(True, encode_response, deepcopy(result))
+
+    async def _offload(
+        self,
+        offload: bool,
+        func: Callable,
+        *args
+    ) -> Any:
+        if not offload:
+            return func(*args)
+        return await get_event_loop().run_in_executor(
+            self.request.app['executor'], func, *args)
+
     async def rpc_multicall(self, call_list):
         results = []
         for call in call_list:
@@ -99,6 +220,30 @@ class MasterApi(XMLRPCView):
             key, value, caller_id)
         return 1, '', 0
 
+    async def rpc_getParams(
+        self,
+        caller_id: str,
+        keys: List[str]
+    ) -> Tuple[int, str, List[AnyResult]]:
+        return 1, '', [await self.rpc_getParam(caller_id, key) for key in keys]
+
+    async def rpc_setParams(
+        self,
+        caller_id: str,
+        params: List[Tuple[str, Any]]
+    ) -> IntResult:
+        param_cache = self.request.app['param_cache']
+        registration_manager = self.request.app['registration_manager']
+        updates = registration_manager.select_param_subscribers(
+            params, caller_id)
+        try:
+            for key, value in params:
+                param_cache[key] = value
+        finally:
+            registration_manager.notify_param_subscribers(
+                updates, param_cache.__getitem__)
+        return 1, '', 0
+
     async def rpc_searchParam(
         self,
         caller_id: str,
@@ -170,8 +315,11 @@ class MasterApi(XMLRPCView):
         caller_id: str,
         service: str
     ) -> StrResult:
-        return 1, '', self.request.app['registration_manager'].get_service_api(
-            service)
+        registration_manager = self.request.app['registration_manager']
+        try:
+            return 1, '', registration_manager.get_service_api(service)
+        except KeyError:
+            return -1, f'no provider for {service}', ''
 
     async def rpc_unregisterService(
         self,
@@ -290,16 +438,260 @@ class MasterApi(XMLRPCView):
              for topic, services in reg.services.items() if services]
         )
 
+    async def rpc_getSystemStateDelta(
+        self,
+        caller_id: str,
+        version: str
+    ) -> Tuple[int, str, Tuple[str, bool, SystemStateChanges]]:
+        reg = self.request.app['registration_manager']
+        return 1, '', reg.get_changes_since(version)
+
+
+class ProxyMasterApi(MasterApi):
+
+    @property
+    def upstream(self) -> UpstreamMaster:
+        return self.request.app['upstream']
+
+    async def _forward(self, method: str, *args) -> AnyResult:
+        try:
+            return 1, '', await self.upstream.call(method, *args)
+        except UpstreamError as e:
+            return e.code, e.msg, 0
+
+    async def rpc_paramUpdate(
+        self,
+        caller_id: str,
+        key: str,
+        value: Any
+    ) -> IntResult:
+        key = key or '/'
+        param_cache = self.request.app['param_cache']
+        if value == {} and key != '/':
+            # deleted and set to {} upstream look the same, ask upstream
+            code, _, value = await self._forward(
+                'getParam', self.upstream.caller_id, key)
+            if code != 1:
+                try:
+                    del param_cache[key]
+                except KeyError:
+                    pass
+                return 1, '', 0
+        param_cache[key] = value
+        return 1, '', 0
+
+    async def rpc_deleteParam(
+        self,
+        caller_id: str,
+        key: str
+    ) -> IntResult:
+        result = await self._forward('deleteParam', caller_id, key)
+        if result[0] == 1:
+            try:
+                del self.request.app['param_cache'][key]
+            except KeyError:
+                pass
+        return result
+
+    async def rpc_setParam(
+        self,
+        caller_id: str,
+        key: str,
+        value: Any
+    ) -> IntResult:
+        result = await self._forward('setParam', caller_id, key, value)
+        if result[0] == 1:
+            self.request.app['param_cache'][key] = value
+        return result
+
+    async def rpc_setParams(
+        self,
+        caller_id: str,
+        params: List[Tuple[str, Any]]
+    ) -> IntResult:
+        try:
+            await self.upstream.call('setParams', caller_id, params)
+        except UpstreamFault:
+            # a stock rosmaster does not provide setParams
+            for index, (key, value) in enumerate(params):
+                result = await self._forward('setParam', caller_id, key, value)
+                if result[0] != 1:
+                    await super().rpc_setParams(caller_id, params[:index])
+                    return result
+        except UpstreamError as e:
+            return e.code, e.msg, 0
+        return await super().rpc_setParams(caller_id, params)
+
+    async def rpc_subscribeParam(
+        self,
+        caller_id: str,
+        caller_api: str,
+        key: str
+    ) -> AnyResult:
+        result = await self._forward(
+            'subscribeParam', caller_id, caller_api, key)
+        if result[0] == 1:
+            self.request.app['registration_manager'] \
+                .register_param_subscriber(key, caller_id, caller_api)
+        return result
+
+    async def rpc_unsubscribeParam(
+        self,
+        caller_id: str,
+        caller_api: str,
+        key: str
+    ) -> IntResult:
+        await super().rpc_unsubscribeParam(caller_id, caller_api, key)
+        return await self._forward(
+            'unsubscribeParam', caller_id, caller_api, key)
+
+    async def rpc_registerService(
+        self,
+        caller_id: str,
+        service: str,
+        service_api: str,
+        caller_api: str
+    ) -> IntResult:
+        result = await self._forward(
+            'registerService', caller_id, service, service_api, caller_api)
+        if result[0] == 1:
+            await super().rpc_registerService(
+                caller_id, service, service_api, caller_api)
+        self.upstream.invalidate('lookupService', service)
+        return result
+
+    async def rpc_lookupService(
+        self,
+        caller_id: str,
+        service: str
+    ) -> StrResult:
+        if self.request.app['registration_manager'].services.get(service):
+            return await super().rpc_lookupService(caller_id, service)
+        try:
+            return 1, '', await self.upstream.cached_lookup(
+                'lookupService', caller_id, service)
+        except UpstreamError as e:
+            return e.code, e.msg, ''
+
+    async def rpc_unregisterService(
+        self,
+        caller_id: str,
+        service: str,
+        service_api: str
+    ) -> IntResult:
+        await super().rpc_unregisterService(caller_id, service, service_api)
+        self.upstream.invalidate('lookupService', service)
+        return await self._forward(
+            'unregisterService', caller_id, service, service_api)
+
+    async def rpc_registerSubscriber(
+        self,
+        caller_id: str,
+        topic: str,
+        topic_type: str,
+        caller_api: str
+    ) -> Tuple[int, str, List[str]]:
+        result = await self._forward(
+            'registerSubscriber', caller_id, topic, topic_type, caller_api)
+        if result[0] == 1:
+            await super().rpc_registerSubscriber(
+                caller_id, topic, topic_type, caller_api)
+        return result
+
+    async def rpc_unregisterSubscriber(
+        self,
+        caller_id: str,
+        topic: str,
+        caller_api: str
+    ) -> IntResult:
+        await super().rpc_unregisterSubscriber(caller_id, topic, caller_api)
+        return await self._forward(
+            'unregisterSubscriber', caller_id, topic, caller_api)
+
+    async def rpc_registerPublisher(
+        self,
+        caller_id: str,
+        topic: str,
+        topic_type: str,
+        caller_api: str
+    ) -> Tuple[int, str, List[str]]:
+        result = await self._forward(
+            'registerPublisher', caller_id, topic, topic_type, caller_api)
+        if result[0] == 1:
+            await super().rpc_registerPublisher(
+                caller_id, topic, topic_type, caller_api)
+        return result
+
+    async def rpc_unregisterPublisher(
+        self,
+        caller_id: str,
+        topic: str,
+        caller_api: str
+    ) -> IntResult:
+        await super().rpc_unregisterPublisher(caller_id, topic, caller_api)
+        return await self._forward(
+            'unregisterPublisher', caller_id, topic, caller_api)
+
+    async def rpc_lookupNode(
+        self,
+        caller_id: str,
+        node_name: str
+    ) -> StrResult:
+        result = await super().rpc_lookupNode(caller_id, node_name)
+        if result[0] == 1:
+            return result
+        try:
+            return 1, '', await self.upstream.cached_lookup(
+                'lookupNode', caller_id, node_name)
+        except UpstreamError as e:
+            return e.code, e.msg, ''
+
+    async def rpc_getPublishedTopics(
+        self,
+        caller_id: str,
+        subgraph: str
+    ) -> Tuple[int, str, List[Tuple[str, str]]]:
+        return await self._forward('getPublishedTopics', caller_id, subgraph)
+
+    async def rpc_getTopicTypes(
+        self,
+        caller_id: str
+    ) -> Tuple[int, str, List[Tuple[str, str]]]:
+        return await self._forward('getTopicTypes', caller_id)
+
+    async def rpc_getSystemState(
+        self,
+        caller_id: str
+    ) -> Tuple[int, str, Tuple[Tuple[str, List[str]],
+                               Tuple[str, List[str]],
+                               Tuple[str, List[str]]]]:
+        return await self._forward('getSystemState', caller_id)
+
+    async def rpc_getSystemStateDelta(
+        self,
+        caller_id: str,
+        version: str
+    ) -> Tuple[int, str, Tuple[str, bool, SystemStateChanges]]:
+        return await self._forward('getSystemStateDelta', caller_id, version)
+
 
 async def start_server(
     host: str,
     port: int,
     param_cache: ParamCache,
-    registration_manager: RegistrationManager
+    registration_manager: RegistrationManager,
+    upstream: UpstreamMaster = None,
+    offload_threshold: Optional[int] = 1 << 20,
+    executor: Executor = None,
+    max_request_size: int = 64 << 20
 ) -> Tuple[AppRunner, str]:
-    app = Application()
-    app.router.add_route('*', '/', MasterApi)
-    app.router.add_route('*', '/RPC2', MasterApi)
+    if offload_threshold is not None and max_request_size <= offload_threshold:
+        raise ValueError(
+            'max_request_size has to be larger than offload_threshold')
+    api = ProxyMasterApi if upstream else MasterApi
+    app = Application(client_max_size=max_request_size)
+    app.router.add_route('*', '/', api)
+    app.router.add_route('*', '/RPC2', api)
     runner = AppRunner(app)
     await runner.setup()
     site = TCPSite(runner, host, port)
@@ -310,5 +702,8 @@ async def start_server(
     app['xmlrpc_uri'] = xmlrpc_uri
     app['param_cache'] = param_cache
     app['registration_manager'] = registration_manager
+    app['upstream'] = upstream
+    app['offload_threshold'] = offload_threshold
+    app['executor'] = executor
 
     return runner, xmlrpc_uri
@@ -0,0 +1,58 @@
+from json import dumps
+from json import loads
+from os import replace
+from typing import Any
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+
+LogEntry = Tuple[str, List[Any]]
+
+
+class RegistrationLog:
+
+    def __init__(
+        self,
+        path: str,
+        compact_threshold: int = 10000
+    ):
+        self.path: str = path
+        self.compact_threshold: int = compact_threshold
+        self._appended: int = 0
+        self._file = None
+
+    def read(self) -> Iterator[LogEntry]:
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        op, args = loads(line)
+                    except ValueError:
+                        # torn write at the end of the log
+                        continue
+                    yield op, args
+        except FileNotFoundError:
+            return
+
+    def append(self, op: str, *args) -> bool:
+        if not self._file:
+            self._file = open(self.path, 'a', buffering=1)
+        self._file.write(dumps((op, args)) + '\n')
+        self._appended += 1
+        return self._appended >= self.compact_threshold
+
+    def compact(self, entries: Iterable[LogEntry]) -> None:
+        self.close()
+        self._appended = 0
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for op, args in entries:
+                f.write(dumps((op, args)) + '\n')
+        replace(tmp_path, self.path)
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
@@ -1,16 +1,33 @@
 from asyncio import gather
+from asyncio import wait_for
+from bisect import bisect_left
 from collections import defaultdict
-from itertools import chain
+from collections import deque
+from functools import wraps
+from logging import getLogger
+from itertools import islice
+from time import perf_counter
 from typing import Any
+from typing import Callable
+from typing import Deque
 from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
 from typing import Set
+from typing import Tuple
+from uuid import uuid4
 
 from aiohttp.client_exceptions import ClientConnectorError
 
 from aioros.api.node_api_client import NodeApiClient
 
+from .registration_log import LogEntry
+from .registration_log import RegistrationLog
+from .service_selection import RoundRobin
+from .service_selection import ServiceSelection
 from .utils import split
 
 
@@ -19,7 +36,18 @@ class Registration(NamedTuple):
     api: str
 
 
+class Change(NamedTuple):
+    version: int
+    category: str
+    added: bool
+    item: Tuple[str, ...]
+
+
 RegistrationMap = Dict[str, Set[Registration]]
+SystemStateChanges = Dict[str, Tuple[List[Tuple[str, str]],
+                                     List[Tuple[str, str]]]]
+
+CHANGE_CATEGORIES = ('publishers', 'subscribers', 'services', 'topic_types')
 
 
 class Node:
@@ -30,6 +58,7 @@ class Node:
         self.topic_subscriptions: set = set()
         self.topic_publications: set = set()
         self.services: set = set()
+        self.rtt: Optional[float] = None
         self._api_client = None
 
     @property
@@ -50,19 +79,27 @@ class Node:
             await self._api_client.close()
             self._api_client = None
 
+    async def _timed(self, coro) -> Any:
+        start = perf_counter()
+        result = await coro
+        rtt = perf_counter() - start
+        # exponentially weighted moving average of the callback round trips
+        self.rtt = rtt if self.rtt is None else 0.8 * self.rtt + 0.2 * rtt
+        return result
+
     async def publisher_update(
         self,
         topic: str,
         publishers: List[str]
     ) -> None:
-        await self.api_client.publisher_update(topic, publishers)
+        await self._timed(self.api_client.publisher_update(topic, publishers))
 
     async def param_update(
         self,
         key: str,
         value: Any
     ) -> None:
-        await self.api_client.param_update(key, value)
+        await self._timed(self.api_client.param_update(key, value))
 
     async def shutdown(
         self,
@@ -70,6 +107,13 @@ class Node:
     ) -> None:
         await self.api_client.shutdown(msg)
 
+    async def is_alive(self, timeout: float = 5.0) -> bool:
+        try:
+            await wait_for(self._timed(self.api_client.get_pid()), timeout)
+        except Exception:
+            return False
+        return True
+
     async def shutdown_and_close(
         self,
         msg: str
@@ -90,19 +134,80 @@ def compute_all_keys(key, value):
             yield from compute_all_keys(_key, v)
 
 
+def contains_key(sub_key, value):
+    for ns in split(sub_key):
+        if not isinstance(value, dict) or ns not in value:
+            return False
+        value = value[ns]
+    return True
+
+
+log = getLogger(__name__)
+
+LOGGED_OPERATIONS: Set[str] = set()
+
+
+def logged(method):
+    # Appends the call to the registration log before applying it and
+    # compacts the log afterwards, so the snapshot includes the call.
+    LOGGED_OPERATIONS.add(method.__name__)
+
+    @wraps(method)
+    def wrapper(self, *args) -> None:
+        compact = bool(self._log) and self._log.append(method.__name__, *args)
+        method(self, *args)
+        if compact:
+            self._compact_log()
+
+    return wrapper
+
+
 class RegistrationManager:
 
-    def __init__(self, loop):
+    def __init__(
+        self,
+        loop,
+        notify_nodes: bool = True,
+        registration_log: RegistrationLog = None,
+        service_selection: ServiceSelection = None,
+        journal_size: int = 10000
+    ):
         self._loop = loop
+        self._notify_nodes = notify_nodes
+        self._log = registration_log
+        self._service_selection = service_selection or RoundRobin()
         self.param_subscribers: RegistrationMap = defaultdict(set)
         self.publishers: RegistrationMap = defaultdict(set)
         self.subscribers: RegistrationMap = defaultdict(set)
         self.services: RegistrationMap = defaultdict(set)
         self.topic_types: Dict[str, str] = {}
         self._nodes: Dict[str, Node] = {}
+        self._epoch: str = uuid4().hex[:8]
+        self._version: int = 0
+        self._journal: Deque[Change] = deque(maxlen=journal_size)
 
     async def close(self):
         await gather(*[node.close() for node in self._nodes.values()])
+        if self._log:
+            self._log.close()
+
+    def replay_log(self) -> None:
+        log, notify_nodes = self._log, self._notify_nodes
+        self._log, self._notify_nodes = None, False
+        try:
+            for op, args in log.read():
+                if op in LOGGED_OPERATIONS:
+                    getattr(self, op)(*args)
+        finally:
+            self._log, self._notify_nodes = log, notify_nodes
+        self._compact_log()
+
+    async def check_liveness(self) -> None:
+        nodes = list(self._nodes.items())
+        alive = await gather(*[node.is_alive() for _, node in nodes])
+        for (caller_id, node), is_alive in zip(nodes, alive):
+            if not is_alive and self._nodes.get(caller_id) is node:
+                self.unregister_node(caller_id)
 
     def on_param_update(
         self,
@@ -110,7 +215,7 @@ class RegistrationManager:
         param_value: Any,
         caller_id_to_ignore: str
     ) -> None:
-        if not self.param_subscribers:
+        if not self._notify_nodes or not self.param_subscribers:
             return
 
         if param_key != '/':
@@ -155,6 +260,70 @@ class RegistrationManager:
                 node = self._nodes[registration.caller_id]
                 self._loop.create_task(node.param_update(key[:-1], value))
 
+    def select_param_subscribers(
+        self,
+        params: Sequence[Tuple[str, Any]],
+        caller_id_to_ignore: str
+    ) -> RegistrationMap:
+        # Selects the same subscriptions as calling on_param_update for
+        # every param in turn. Has to be called before the params are
+        # written, later writes may modify the values of earlier ones.
+        updates: RegistrationMap = defaultdict(set)
+        if not self._notify_nodes or not self.param_subscribers:
+            return updates
+
+        subscribed_keys = sorted(self.param_subscribers)
+
+        for param_key, param_value in params:
+            if param_key != '/':
+                param_key = '/' + '/'.join(split(param_key)) + '/'
+
+            namespaces = ['/']
+            for ns in split(param_key):
+                namespaces.append(namespaces[-1] + ns + '/')
+            for namespace in namespaces:
+                updates[namespace].update(
+                    registration
+                    for registration in self.param_subscribers.get(
+                        namespace, ())
+                    if registration.caller_id != caller_id_to_ignore)
+
+            if not isinstance(param_value, dict):
+                continue
+
+            index = bisect_left(subscribed_keys, param_key)
+            for key in islice(subscribed_keys, index, None):
+                if not key.startswith(param_key):
+                    break
+                if key == param_key:
+                    continue
+                if contains_key(key[len(param_key):], param_value):
+                    updates[key].update(self.param_subscribers[key])
+                else:
+                    updates[key].update(
+                        registration
+                        for registration in self.param_subscribers[key]
+                        if registration.caller_id != caller_id_to_ignore)
+
+        return updates
+
+    def notify_param_subscribers(
+        self,
+        updates: RegistrationMap,
+        get_value: Callable[[str], Any]
+    ) -> None:
+        for key, registrations in updates.items():
+            if not registrations:
+                continue
+            try:
+                value = get_value(key)
+            except KeyError:
+                value = {}
+            for registration in registrations:
+                node = self._nodes[registration.caller_id]
+                self._loop.create_task(node.param_update(key[:-1], value))
+
+    @logged
     def register_param_subscriber(
         self,
         key: str,
@@ -169,6 +338,7 @@ class RegistrationManager:
 
         self.param_subscribers[key].add(Registration(caller_id, caller_api))
 
+    @logged
     def register_publisher(
         self,
         topic: str,
@@ -178,11 +348,11 @@ class RegistrationManager:
     ) -> None:
         self._register_node(caller_id, caller_api) \
             .topic_publications.add(topic)
-        self.publishers[topic].add(Registration(caller_id, caller_api))
-        if topic_type != '*' and topic not in self.topic_types:
-            self.topic_types[topic] = topic_type
+        self._add('publishers', topic, Registration(caller_id, caller_api))
+        self._set_topic_type(topic, topic_type)
         self._schedule_subscriber_update(topic)
 
+    @logged
     def register_subscriber(
         self,
         topic: str,
@@ -192,10 +362,10 @@ class RegistrationManager:
     ) -> None:
         self._register_node(caller_id, caller_api) \
             .topic_subscriptions.add(topic)
-        self.subscribers[topic].add(Registration(caller_id, caller_api))
-        if topic_type != '*' and topic not in self.topic_types:
-            self.topic_types[topic] = topic_type
+        self._add('subscribers', topic, Registration(caller_id, caller_api))
+        self._set_topic_type(topic, topic_type)
 
+    @logged
     def register_service(
         self,
         name: str,
@@ -203,17 +373,21 @@ class RegistrationManager:
         caller_api: str,
         service_api: str
     ) -> None:
-        self._register_node(caller_id, caller_api) \
-            .services.add(name)
-        self.services[name].add(Registration(caller_id, service_api))
-
+        node = self._register_node(caller_id, caller_api)
+        node.services.add(name)
+        self._add('services', name, Registration(caller_id, service_api))
+        if (self._notify_nodes
+                and self._service_selection.uses_rtt
+                and node.rtt is None):
+            self._loop.create_task(node.is_alive())
+
+    @logged
     def unregister_param_subscriber(
         self,
         key: str,
         caller_id: str,
         caller_api: str
     ) -> None:
-
         if key != '/':
             key = '/' + '/'.join(split(key)) + '/'
 
@@ -230,6 +404,7 @@ class RegistrationManager:
             pass
         self._check_node(caller_id)
 
+    @logged
     def unregister_publisher(
         self,
         topic: str,
@@ -237,7 +412,8 @@ class RegistrationManager:
         caller_api: str
     ) -> None:
         try:
-            self.publishers[topic].remove(Registration(caller_id, caller_api))
+            self._remove(
+                'publishers', topic, Registration(caller_id, caller_api))
             if not self.publishers[topic]:
                 del self.publishers[topic]
         except KeyError:
@@ -249,6 +425,7 @@ class RegistrationManager:
             pass
         self._check_node(caller_id)
 
+    @logged
     def unregister_subscriber(
         self,
         topic: str,
@@ -256,7 +433,8 @@ class RegistrationManager:
         caller_api: str
     ) -> None:
         try:
-            self.subscribers[topic].remove(Registration(caller_id, caller_api))
+            self._remove(
+                'subscribers', topic, Registration(caller_id, caller_api))
             if not self.subscribers[topic]:
                 del self.subscribers[topic]
         except KeyError:
@@ -267,6 +445,7 @@ class RegistrationManager:
             pass
         self._check_node(caller_id)
 
+    @logged
     def unregister_service(
         self,
         service: str,
@@ -274,27 +453,95 @@ class RegistrationManager:
         service_api: str
     ) -> None:
         try:
-            self.services[service].remove(Registration(caller_id, service_api))
+            self._remove(
+                'services', service, Registration(caller_id, service_api))
         except KeyError:
             pass
 
         if not self.services.get(service, True):
             del self.services[service]
+            self._service_selection.forget(service)
 
-        try:
-            self._nodes[caller_id].services.remove(service)
-        except KeyError:
-            pass
+        # a caller may provide a service under several service apis
+        if not any(reg.caller_id == caller_id
+                   for reg in self.services.get(service, ())):
+            try:
+                self._nodes[caller_id].services.remove(service)
+            except KeyError:
+                pass
 
         self._check_node(caller_id)
 
+    @logged
+    def unregister_node(self, caller_id: str) -> None:
+        node = self._nodes.pop(caller_id, None)
+        if not node:
+            return
+        self._unregister_all(caller_id)
+        for topic in node.topic_publications:
+            self._schedule_subscriber_update(topic)
+        self._loop.create_task(node.close())
+
     def get_service_api(self, service: str) -> str:
-        return next(self.services[service]).api
+        providers = [
+            (reg, self._nodes[reg.caller_id])
+            for reg in self.services.get(service, ())
+            if reg.caller_id in self._nodes]
+        if not providers:
+            raise KeyError(service)
+        return self._service_selection.select(service, providers).api
 
     def get_caller_api(self, node_name: str) -> str:
         return self._nodes[node_name].api
 
+    @property
+    def version(self) -> str:
+        return f'{self._epoch}:{self._version}'
+
+    def get_changes_since(
+        self,
+        version: str
+    ) -> Tuple[str, bool, SystemStateChanges]:
+        epoch, _, since = version.partition(':')
+        try:
+            since = int(since)
+        except ValueError:
+            since = -1
+        oldest = self._journal[0].version if self._journal else None
+        if (epoch != self._epoch
+                or not 0 <= since <= self._version
+                or (since < self._version
+                    and (oldest is None or oldest > since + 1))):
+            return self.version, True, self._full_state()
+
+        # Changes alternate per registration, so a registration changed an
+        # even number of times since the given version ends up where it
+        # started. As in getSystemState a caller_id is listed once per
+        # registration, so the net changes are counted per caller_id.
+        first: Dict[Tuple[str, Tuple[str, ...]], bool] = {}
+        last: Dict[Tuple[str, Tuple[str, ...]], bool] = {}
+        for change in self._journal:
+            if change.version <= since:
+                continue
+            key = change.category, change.item
+            first.setdefault(key, change.added)
+            last[key] = change.added
+
+        changes = {category: ([], []) for category in CHANGE_CATEGORIES}
+        counts: Dict[Tuple[str, Tuple[str, str]], int] = defaultdict(int)
+        for (category, item), added in last.items():
+            if category == 'topic_types':
+                changes[category][0].append(item)
+            elif first[category, item] == added:
+                counts[category, item[:2]] += 1 if added else -1
+        for (category, item), count in counts.items():
+            changes[category][0 if count > 0 else 1].extend(
+                [item] * abs(count))
+        return self.version, False, changes
+
     def _schedule_subscriber_update(self, topic: str) -> None:
+        if not self._notify_nodes:
+            return
         publishers = [
             publisher.api
             for publisher in self.publishers[topic]]
@@ -305,6 +552,78 @@ class RegistrationManager:
                 publishers
             ))
 
+    def _add(
+        self,
+        category: str,
+        key: str,
+        registration: Registration
+    ) -> None:
+        registrations = getattr(self, category)[key]
+        if registration not in registrations:
+            registrations.add(registration)
+            self._record(category, True, (key, *registration))
+
+    def _remove(
+        self,
+        category: str,
+        key: str,
+        registration: Registration
+    ) -> None:
+        getattr(self, category)[key].remove(registration)
+        self._record(category, False, (key, *registration))
+
+    def _set_topic_type(self, topic: str, topic_type: str) -> None:
+        if topic_type != '*' and topic not in self.topic_types:
+            self.topic_types[topic] = topic_type
+            self._record('topic_types', True, (topic, topic_type))
+
+    def _record(
+        self,
+        category: str,
+        added: bool,
+        item: Tuple[str, ...]
+    ) -> None:
+        self._version += 1
+        self._journal.append(Change(self._version, category, added, item))
+
+    def _full_state(self) -> SystemStateChanges:
+        changes = {}
+        for category in CHANGE_CATEGORIES[:3]:
+            changes[category] = [
+                (key, reg.caller_id)
+                for key, registrations in getattr(self, category).items()
+                for reg in registrations], []
+        changes['topic_types'] = list(self.topic_types.items()), []
+        return changes
+
+    def _snapshot(self) -> Iterator[LogEntry]:
+        for key, registrations in self.param_subscribers.items():
+            for reg in registrations:
+                yield 'register_param_subscriber', [key, *reg]
+        for topic, registrations in self.publishers.items():
+            topic_type = self.topic_types.get(topic, '*')
+            for reg in registrations:
+                yield 'register_publisher', [topic, topic_type, *reg]
+        for topic, registrations in self.subscribers.items():
+            topic_type = self.topic_types.get(topic, '*')
+            for reg in registrations:
+                yield 'register_subscriber', [topic, topic_type, *reg]
+        for service, registrations in self.services.items():
+            for reg in registrations:
+                node = self._nodes.get(reg.caller_id)
+                if node:
+                    yield 'register_service', [
+                        service, reg.caller_id, node.api, reg.api]
+
+    def _compact_log(self) -> None:
+        # The operation itself has been applied already, so a failing
+        # compaction must not turn it into an error. The log keeps growing
+        # until the next attempt.
+        try:
+            self._log.compact(self._snapshot())
+        except Exception:
+            log.exception('Compacting the registration log failed')
+
     def _check_node(self, caller_id):
         node = self._nodes.get(caller_id)
         if node and not node.has_any_registration:
@@ -316,8 +635,9 @@ class RegistrationManager:
         if node and node.api == caller_api:
             return node
         elif node:
-            self._loop.create_task(node.shutdown_and_close(
-                'new node registered with same name'))
+            if self._notify_nodes:
+                self._loop.create_task(node.shutdown_and_close(
+                    'new node registered with same name'))
             self._unregister_all(caller_id)
             node = None
 
@@ -326,11 +646,18 @@ class RegistrationManager:
         return node
 
     def _unregister_all(self, caller_id: str) -> None:
-        registrations_chained = chain(self.param_subscribers.values(),
-                                      self.publishers.values(),
-                                      self.subscribers.values(),
-                                      self.services.values())
-
-        for registrations in registrations_chained:
+        for registrations in self.param_subscribers.values():
             registrations -= set(reg for reg in registrations
                                  if reg.caller_id == caller_id)
+
+        for category in CHANGE_CATEGORIES[:3]:
+            for key, registrations in getattr(self, category).items():
+                for reg in [reg for reg in registrations
+                            if reg.caller_id == caller_id]:
+                    self._remove(category, key, reg)
+
+        for service in [service
+                        for service, registrations in self.services.items()
+                        if not registrations]:
+            del self.services[service]
+            self._service_selection.forget(service)
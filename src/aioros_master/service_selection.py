@@ -0,0 +1,99 @@
+from abc import ABC
+from abc import abstractmethod
+from collections import defaultdict
+from itertools import count
+from random import choices
+from typing import Dict
+from typing import Sequence
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .registration_manager import Node
+    from .registration_manager import Registration
+
+Provider = Tuple['Registration', 'Node']
+
+
+class ServiceSelection(ABC):
+
+    uses_rtt: bool = False
+
+    @abstractmethod
+    def select(
+        self,
+        service: str,
+        providers: Sequence[Provider]
+    ) -> 'Registration':
+        pass
+
+    def forget(self, service: str) -> None:
+        pass
+
+
+class RoundRobin(ServiceSelection):
+
+    def __init__(self):
+        self._counters: Dict[str, int] = defaultdict(int)
+
+    def select(
+        self,
+        service: str,
+        providers: Sequence[Provider]
+    ) -> 'Registration':
+        registrations = sorted(reg for reg, _ in providers)
+        index = self._counters[service] % len(registrations)
+        self._counters[service] += 1
+        return registrations[index]
+
+    def forget(self, service: str) -> None:
+        self._counters.pop(service, None)
+
+
+class LeastRecentlyReturned(ServiceSelection):
+
+    def __init__(self):
+        self._ticks = count()
+        self._returned: Dict[str, Dict['Registration', int]] = {}
+
+    def select(
+        self,
+        service: str,
+        providers: Sequence[Provider]
+    ) -> 'Registration':
+        returned = self._returned.get(service, {})
+        returned = {reg: returned.get(reg, -1) for reg, _ in providers}
+        registration = min(returned, key=lambda reg: (returned[reg], reg))
+        returned[registration] = next(self._ticks)
+        self._returned[service] = returned
+        return registration
+
+    def forget(self, service: str) -> None:
+        self._returned.pop(service, None)
+
+
+class LatencyAware(ServiceSelection):
+    # Providers are picked randomly, weighted by the inverse of the round
+    # trip time observed on master -> node callbacks. Providers without a
+    # measurement yet are treated like the fastest known one.
+
+    uses_rtt = True
+
+    def select(
+        self,
+        service: str,
+        providers: Sequence[Provider]
+    ) -> 'Registration':
+        rtts = [node.rtt for _, node in providers]
+        known = [rtt for rtt in rtts if rtt is not None]
+        fastest = min(known) if known else 1.0
+        weights = [1.0 / max(rtt if rtt is not None else fastest, 1e-6)
+                   for rtt in rtts]
+        return choices([reg for reg, _ in providers], weights)[0]
+
+
+SERVICE_SELECTIONS = {
+    'round_robin': RoundRobin,
+    'least_recently_returned': LeastRecentlyReturned,
+    'latency_aware': LatencyAware,
+}
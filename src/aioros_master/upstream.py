@@ -0,0 +1,132 @@
+from asyncio import CancelledError
+from asyncio import Task
+from asyncio import TimeoutError
+from asyncio import sleep
+from re import sub
+from time import monotonic
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+from urllib.parse import urlparse
+
+from aiohttp import ClientError
+from aiohttp_xmlrpc.client import ServerProxy
+
+from .param_cache import ParamCache
+
+
+class UpstreamError(Exception):
+
+    def __init__(self, method: str, code: int, msg: str):
+        super().__init__(f'{method} failed upstream ({code}): {msg}')
+        self.method = method
+        self.code = code
+        self.msg = msg
+
+
+class UpstreamFault(UpstreamError):
+    pass
+
+
+class UpstreamMaster:
+
+    def __init__(
+        self,
+        loop,
+        uri: str,
+        lookup_ttl: float = 5.0,
+        check_interval: float = 5.0,
+    ):
+        self._loop = loop
+        self.uri: str = uri
+        self.lookup_ttl: float = lookup_ttl
+        self.check_interval: float = check_interval
+        self.caller_id: Optional[str] = None
+        self._caller_api: Optional[str] = None
+        self._client: Optional[ServerProxy] = None
+        self._param_cache: Optional[ParamCache] = None
+        self._lookups: Dict[Tuple[str, str], Tuple[float, str]] = {}
+        self._pid: Optional[int] = None
+        self._stale: bool = False
+        self._watch: Optional[Task] = None
+
+    async def init(
+        self,
+        param_cache: ParamCache,
+        caller_api: str
+    ) -> None:
+        self._client = ServerProxy(self.uri, loop=self._loop)
+        self._param_cache = param_cache
+        self._caller_api = caller_api
+        self.caller_id = '/master_proxy_' + sub(
+            r'\W', '_', urlparse(caller_api).netloc)
+        await self._subscribe()
+        self._watch = self._loop.create_task(self._watch_upstream())
+
+    async def _subscribe(self) -> None:
+        self._pid = await self.call('getPid', self.caller_id)
+        self._param_cache['/'] = await self.call(
+            'subscribeParam', self.caller_id, self._caller_api, '/')
+        self._lookups.clear()
+        self._stale = False
+
+    async def _watch_upstream(self) -> None:
+        # A restarted upstream master has lost the param subscription, so
+        # renew it whenever the pid changes or a call to upstream failed.
+        while True:
+            await sleep(self.check_interval)
+            try:
+                pid = await self.call('getPid', self.caller_id)
+                if self._stale or pid != self._pid:
+                    await self._subscribe()
+            except UpstreamError:
+                pass
+
+    async def close(self) -> None:
+        if self._watch:
+            self._watch.cancel()
+            self._watch = None
+        if not self._client:
+            return
+        try:
+            await self.call(
+                'unsubscribeParam', self.caller_id, self._caller_api, '/')
+        except Exception:
+            pass
+        finally:
+            await self._client.close()
+            self._client = None
+            self._lookups.clear()
+
+    async def call(self, method: str, *args) -> Any:
+        try:
+            code, msg, value = await getattr(self._client, method)(*args)
+        except CancelledError:
+            raise
+        except (ClientError, OSError, TimeoutError) as e:
+            # only a broken link can mean the upstream master restarted
+            self._stale = True
+            raise UpstreamError(method, -1, str(e)) from e
+        except Exception as e:
+            raise UpstreamFault(method, -1, str(e)) from e
+        if code != 1:
+            raise UpstreamError(method, code, msg)
+        return value
+
+    async def cached_lookup(
+        self,
+        method: str,
+        caller_id: str,
+        name: str
+    ) -> str:
+        now = monotonic()
+        cached = self._lookups.get((method, name))
+        if cached and cached[0] > now:
+            return cached[1]
+        value = await self.call(method, caller_id, name)
+        self._lookups[(method, name)] = now + self.lookup_ttl, value
+        return value
+
+    def invalidate(self, method: str, name: str) -> None:
+        self._lookups.pop((method, name), None)
@@ -0,0 +1,101 @@
+from asyncio import new_event_loop
+from asyncio import sleep
+from copy import deepcopy
+from types import SimpleNamespace
+
+from aioros_master.master_api_server import MasterApi
+from aioros_master.param_cache import ParamCache
+from aioros_master.registration_manager import Node
+from aioros_master.registration_manager import RegistrationManager
+
+
+INITIAL_PARAMS = {'a': {'b': {'c': 1, 'd': 2}, 'e': 3}, 'f': 4}
+
+# caller_id -> subscribed key, at, above and below the written keys
+SUBSCRIPTIONS = {
+    '/n_root': '/',
+    '/n_a': '/a',
+    '/n_ab': '/a/b',
+    '/n_abc': '/a/b/c',
+    '/n_abd': '/a/b/d',
+    '/n_ae': '/a/e',
+    '/n_aey': '/a/e/y',
+    '/n_f': '/f',
+    '/n_g': '/g',
+    '/writer': '/a/b',
+}
+
+WRITES = [
+    ('/a/b/c', 10),
+    # overwrites /a/b and deletes /a/b/d
+    ('/a/b', {'c': 11, 'x': 5}),
+    ('/a/e', {'y': 1}),
+    ('/g/h', 7),
+    ('/a/b/x', 6),
+]
+
+
+def lookup(params, key):
+    try:
+        return params[key]
+    except KeyError:
+        return {}
+
+
+async def run_writes(monkeypatch, loop, batch):
+    updates = []
+
+    async def param_update(node, key, value):
+        updates.append((node.api, key or '/', deepcopy(value)))
+
+    monkeypatch.setattr(Node, 'param_update', param_update)
+
+    param_cache = ParamCache()
+    param_cache['/'] = deepcopy(INITIAL_PARAMS)
+    registration_manager = RegistrationManager(loop)
+    for caller_id, key in SUBSCRIPTIONS.items():
+        registration_manager.register_param_subscriber(
+            key, caller_id, caller_id)
+    api = MasterApi(SimpleNamespace(app={
+        'param_cache': param_cache,
+        'registration_manager': registration_manager}))
+
+    writes = deepcopy(WRITES)
+    if batch:
+        assert await api.rpc_setParams('/writer', writes) == (1, '', 0)
+    else:
+        for key, value in writes:
+            result = await api.rpc_setParam('/writer', key, value)
+            assert result == (1, '', 0)
+    await sleep(0)
+
+    # what each subscriber ends up with after applying its updates
+    views = {}
+    for caller_id in SUBSCRIPTIONS:
+        views[caller_id] = ParamCache()
+        views[caller_id]['/'] = deepcopy(INITIAL_PARAMS)
+    for caller_id, key, value in updates:
+        views[caller_id][key] = value
+
+    return param_cache, {caller_id for caller_id, _, _ in updates}, {
+        caller_id: lookup(views[caller_id], key)
+        for caller_id, key in SUBSCRIPTIONS.items()}
+
+
+def test_set_params_matches_single_writes(monkeypatch):
+    loop = new_event_loop()
+    single_params, single_notified, single_views = loop.run_until_complete(
+        run_writes(monkeypatch, loop, batch=False))
+    batch_params, batch_notified, batch_views = loop.run_until_complete(
+        run_writes(monkeypatch, loop, batch=True))
+    loop.close()
+
+    assert batch_params['/'] == single_params['/']
+    assert batch_notified == single_notified
+    assert '/writer' not in batch_notified
+    assert '/n_f' not in batch_notified
+    for caller_id, key in SUBSCRIPTIONS.items():
+        if caller_id == '/writer':
+            continue
+        assert batch_views[caller_id] == single_views[caller_id], caller_id
+        assert batch_views[caller_id] == lookup(batch_params, key), caller_id
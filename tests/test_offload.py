@@ -0,0 +1,73 @@
+from asyncio import new_event_loop
+from asyncio import sleep
+from types import SimpleNamespace
+
+from aiohttp import ClientSession
+from lxml import etree
+
+from aioros_master import Master
+from aioros_master.master_api_server import MasterApi
+from aioros_master.param_cache import ParamCache
+
+
+async def encode_while_writing(loop):
+    param_cache = ParamCache()
+    for i in range(20000):
+        param_cache[f'/ns_{i % 100}/key_{i}'] = 'x' * 32
+    api = MasterApi(SimpleNamespace(app={
+        'param_cache': param_cache,
+        'offload_threshold': 1,
+        'executor': None}))
+
+    result = await api.rpc_getParam('/test', '/')
+    encoding = loop.create_task(api._encode(result))
+    i = 0
+    while not encoding.done():
+        param_cache[f'/new_{i}'] = i
+        i += 1
+        await sleep(0)
+    return await encoding
+
+
+def test_offloaded_encoding_of_changing_param_cache():
+    loop = new_event_loop()
+    try:
+        response = loop.run_until_complete(encode_while_writing(loop))
+    finally:
+        loop.close()
+    root = etree.fromstring(response)
+    assert root.tag == 'methodResponse'
+    assert root.find('fault') is None
+
+
+async def post_requests(loop, offload_threshold):
+    master = Master()
+    await master.init(
+        loop,
+        host='127.0.0.1',
+        port=0,
+        offload_threshold=offload_threshold)
+    statuses = []
+    try:
+        async with ClientSession() as session:
+            for body, content_type in (
+                    (b'<methodCall/>', 'text/plain'),
+                    (b'<methodCall><foo/></methodCall>', 'text/xml')):
+                async with session.post(
+                        master.uri,
+                        data=body,
+                        headers={'Content-Type': content_type}) as response:
+                    statuses.append(response.status)
+    finally:
+        await master.close()
+    return statuses
+
+
+def test_invalid_requests_are_rejected():
+    loop = new_event_loop()
+    try:
+        for offload_threshold in (None, 1):
+            assert loop.run_until_complete(
+                post_requests(loop, offload_threshold)) == [400, 400]
+    finally:
+        loop.close()
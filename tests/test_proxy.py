@@ -0,0 +1,107 @@
+from asyncio import new_event_loop
+from asyncio import set_event_loop
+from asyncio import sleep
+from time import monotonic
+
+from aiohttp import ClientConnectionError
+from aiohttp_xmlrpc.client import ServerProxy
+from pytest import raises
+
+from aioros_master import Master
+from aioros_master.upstream import UpstreamError
+from aioros_master.upstream import UpstreamFault
+from aioros_master.upstream import UpstreamMaster
+
+
+async def wait_for_result(call, expected, timeout=5.0):
+    deadline = monotonic() + timeout
+    while True:
+        result = await call()
+        if result == expected or monotonic() > deadline:
+            return result
+        await sleep(0.05)
+
+
+async def run_proxy_test(loop):
+    upstream = Master()
+    await upstream.init(loop, host='127.0.0.1', port=0)
+    proxy = Master()
+    await proxy.init(
+        loop, host='127.0.0.1', port=0, upstream_uri=upstream.uri)
+    upstream_client = ServerProxy(upstream.uri, loop=loop)
+    proxy_client = ServerProxy(proxy.uri, loop=loop)
+
+    try:
+        # params set upstream are mirrored
+        await upstream_client.setParam('/test', '/a/b', 1)
+        assert await wait_for_result(
+            lambda: proxy_client.getParam('/test', '/a/b'),
+            [1, '', 1]) == [1, '', 1]
+
+        # writes are forwarded upstream
+        assert await proxy_client.setParam('/test', '/c', 'x') == [1, '', 0]
+        assert await upstream_client.getParam('/test', '/c') == [1, '', 'x']
+        assert await proxy_client.getParam('/test', '/c') == [1, '', 'x']
+
+        assert (await proxy_client.deleteParam('/test', '/c'))[0] == 1
+        assert (await upstream_client.getParam('/test', '/c'))[0] == -1
+        assert (await proxy_client.getParam('/test', '/c'))[0] == -1
+
+        # an empty dict set upstream is not mistaken for a deletion
+        await upstream_client.setParam('/test', '/d', {})
+        assert await wait_for_result(
+            lambda: proxy_client.getParam('/test', '/d'),
+            [1, '', {}]) == [1, '', {}]
+
+        # while a deletion upstream is mirrored as one
+        await upstream_client.deleteParam('/test', '/a/b')
+        result = await wait_for_result(
+            lambda: proxy_client.getParam('/test', '/a/b'),
+            [-1, '', 0])
+        assert result[0] == -1
+
+        # nodes not registered at the proxy are looked up upstream
+        await upstream_client.registerPublisher(
+            '/remote', '/chatter', 'std_msgs/String', 'http://127.0.0.1:1/')
+        assert await proxy_client.lookupNode('/test', '/remote') == \
+            [1, '', 'http://127.0.0.1:1/']
+        assert (await proxy_client.lookupNode('/test', '/unknown'))[0] == -1
+    finally:
+        await upstream_client.close()
+        await proxy_client.close()
+        await proxy.close()
+        await upstream.close()
+
+
+def test_proxy_master():
+    loop = new_event_loop()
+    set_event_loop(loop)
+    try:
+        loop.run_until_complete(run_proxy_test(loop))
+    finally:
+        loop.close()
+
+
+class FailingClient:
+
+    def __init__(self, exception):
+        self.exception = exception
+
+    async def setParams(self, *args):
+        raise self.exception
+
+
+def test_only_transport_errors_mark_the_mirror_stale():
+    loop = new_event_loop()
+    upstream = UpstreamMaster(loop, 'http://127.0.0.1:1/')
+
+    upstream._client = FailingClient(Exception('unknown method setParams'))
+    with raises(UpstreamFault):
+        loop.run_until_complete(upstream.call('setParams', '/test', []))
+    assert not upstream._stale
+
+    upstream._client = FailingClient(ClientConnectionError())
+    with raises(UpstreamError):
+        loop.run_until_complete(upstream.call('setParams', '/test', []))
+    assert upstream._stale
+    loop.close()
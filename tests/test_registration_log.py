@@ -0,0 +1,89 @@
+from asyncio import new_event_loop
+from json import dumps
+
+from aioros_master.registration_log import RegistrationLog
+from aioros_master.registration_manager import RegistrationManager
+
+
+def replayed(loop, path):
+    manager = RegistrationManager(
+        loop, notify_nodes=False, registration_log=RegistrationLog(path))
+    manager.replay_log()
+    return manager
+
+
+def test_replay_across_compaction(tmp_path):
+    loop = new_event_loop()
+    path = str(tmp_path / 'registrations.log')
+    manager = RegistrationManager(
+        loop,
+        notify_nodes=False,
+        registration_log=RegistrationLog(path, compact_threshold=3))
+    for topic in ('/a', '/b', '/c', '/d'):
+        manager.register_publisher(
+            topic, 'std_msgs/String', '/node', 'http://host:1/')
+    manager.unregister_publisher('/b', '/node', 'http://host:1/')
+    manager._log.close()
+
+    restored = replayed(loop, path)
+    assert {topic for topic, regs in restored.publishers.items() if regs} \
+        == {'/a', '/c', '/d'}
+    assert restored.get_caller_api('/node') == 'http://host:1/'
+    loop.close()
+
+
+def test_replay_skips_unknown_operations(tmp_path):
+    loop = new_event_loop()
+    path = tmp_path / 'registrations.log'
+    path.write_text(
+        dumps(['close', []]) + '\n'
+        + dumps(['replay_log', []]) + '\n'
+        + dumps(['register_subscriber',
+                 ['/a', 'std_msgs/String', '/node', 'http://host:1/']])
+        + '\n'
+        + '["register_publisher", ["/torn')
+
+    restored = replayed(loop, str(path))
+    assert restored.subscribers['/a']
+    assert not restored.publishers
+    loop.close()
+
+
+def test_compaction_with_several_service_apis(tmp_path):
+    loop = new_event_loop()
+    path = str(tmp_path / 'registrations.log')
+    manager = RegistrationManager(
+        loop,
+        notify_nodes=False,
+        registration_log=RegistrationLog(path, compact_threshold=5))
+    manager.register_service('/s', '/n', 'http://host:1/', 'rosrpc://a')
+    manager.register_service('/s', '/n', 'http://host:1/', 'rosrpc://b')
+    manager.unregister_service('/s', '/n', 'rosrpc://a')
+    for topic in ('/a', '/b', '/c', '/d'):
+        manager.register_subscriber(
+            topic, 'std_msgs/String', '/m', 'http://host:2/')
+    manager._log.close()
+
+    restored = replayed(loop, path)
+    assert restored.get_service_api('/s') == 'rosrpc://b'
+    assert len(restored.subscribers) == 4
+    loop.close()
+
+
+def test_failed_compaction_does_not_fail_operations(tmp_path):
+    loop = new_event_loop()
+    path = str(tmp_path / 'registrations.log')
+    manager = RegistrationManager(
+        loop,
+        notify_nodes=False,
+        registration_log=RegistrationLog(path, compact_threshold=2))
+    # compaction cannot replace a directory
+    (tmp_path / 'registrations.log.tmp').mkdir()
+    for topic in ('/a', '/b', '/c', '/d', '/e'):
+        manager.register_subscriber(
+            topic, 'std_msgs/String', '/m', 'http://host:2/')
+    manager._log.close()
+
+    restored = replayed(loop, path)
+    assert len(restored.subscribers) == 5
+    loop.close()
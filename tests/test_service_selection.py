@@ -0,0 +1,48 @@
+from asyncio import new_event_loop
+
+from aioros_master.registration_manager import RegistrationManager
+from aioros_master.service_selection import RoundRobin
+
+
+def test_round_robin_over_providers():
+    loop = new_event_loop()
+    manager = RegistrationManager(loop, notify_nodes=False)
+    for i in range(3):
+        manager.register_service(
+            '/srv', f'/n{i}', f'http://host:{i}/', f'rosrpc://host:{i}')
+
+    apis = [manager.get_service_api('/srv') for _ in range(6)]
+    assert apis[:3] == apis[3:]
+    assert sorted(apis[:3]) == [f'rosrpc://host:{i}' for i in range(3)]
+    loop.close()
+
+
+def test_selection_state_is_dropped_with_last_provider():
+    loop = new_event_loop()
+    selection = RoundRobin()
+    manager = RegistrationManager(
+        loop, notify_nodes=False, service_selection=selection)
+    manager.register_service('/srv', '/n', 'http://host:1/', 'rosrpc://a')
+    manager.get_service_api('/srv')
+    assert '/srv' in selection._counters
+
+    manager.unregister_node('/n')
+    assert '/srv' not in manager.services
+    assert '/srv' not in selection._counters
+    loop.close()
+
+
+def test_provider_with_several_service_apis():
+    loop = new_event_loop()
+    manager = RegistrationManager(loop, notify_nodes=False)
+    manager.register_service('/srv', '/n', 'http://host:1/', 'rosrpc://a')
+    manager.register_service('/srv', '/n', 'http://host:1/', 'rosrpc://b')
+    manager.unregister_service('/srv', '/n', 'rosrpc://a')
+    manager.unregister_service('/srv', '/n', 'rosrpc://stale')
+
+    assert manager.get_caller_api('/n') == 'http://host:1/'
+    assert manager.get_service_api('/srv') == 'rosrpc://b'
+
+    manager.unregister_service('/srv', '/n', 'rosrpc://b')
+    assert '/n' not in manager._nodes
+    loop.close()
@@ -0,0 +1,67 @@
+from asyncio import new_event_loop
+
+from aioros_master.registration_manager import RegistrationManager
+
+
+def apply_changes(state, changes):
+    for category, (added, removed) in changes.items():
+        items = state.setdefault(category, [])
+        for item in removed:
+            items.remove(tuple(item))
+        items.extend(tuple(item) for item in added)
+
+
+def system_state(manager):
+    return {
+        category: sorted(
+            (key, reg.caller_id)
+            for key, registrations in getattr(manager, category).items()
+            for reg in registrations)
+        for category in ('publishers', 'subscribers', 'services')}
+
+
+def test_delta_with_several_registrations_of_one_caller():
+    loop = new_event_loop()
+    manager = RegistrationManager(loop, notify_nodes=False)
+    version, full, _ = manager.get_changes_since('')
+    assert full
+
+    manager.register_service('/s', '/n1', 'http://h:0/', 'rosrpc://h:1')
+    version_1 = manager.version
+    manager.register_service('/s', '/n1', 'http://h:0/', 'rosrpc://h:2')
+    manager.unregister_service('/s', '/n1', 'rosrpc://h:1')
+
+    _, full, changes = manager.get_changes_since(version)
+    assert not full
+    assert changes['services'] == ([('/s', '/n1')], [])
+
+    _, full, changes = manager.get_changes_since(version_1)
+    assert not full
+    assert changes['services'] == ([], [])
+    loop.close()
+
+
+def test_delta_matches_full_state():
+    loop = new_event_loop()
+    manager = RegistrationManager(loop, notify_nodes=False)
+    manager.register_publisher('/a', 'T', '/n1', 'http://h:1/')
+    version, full, changes = manager.get_changes_since('')
+    state = {}
+    apply_changes(state, changes)
+
+    manager.register_subscriber('/a', 'T', '/n2', 'http://h:2/')
+    manager.register_publisher('/b', 'U', '/n1', 'http://h:1/')
+    manager.unregister_publisher('/a', '/n1', 'http://h:1/')
+    manager.register_publisher('/a', 'T', '/n1', 'http://h:1/')
+    # node replaced by one with a different api
+    manager.register_publisher('/c', 'V', '/n2', 'http://h:3/')
+
+    version, full, changes = manager.get_changes_since(version)
+    assert not full
+    apply_changes(state, changes)
+    expected = system_state(manager)
+    for category in expected:
+        assert sorted(state[category]) == expected[category]
+    assert sorted(state['topic_types']) == sorted(
+        manager.topic_types.items())
+    loop.close()